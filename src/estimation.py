@@ -1,9 +1,17 @@
 import pandas as pd
 import geopandas as gpd
-import chardet
+import codecs
+from dataclasses import dataclass
+import functools
+import gc
+import hashlib
 import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from shapely.geometry import Point
+import shapely
+from pyproj import Transformer
 
 # ==================== CONFIGURACIÓN DE RUTAS CORREGIDA ====================
 # Obtener la ruta del directorio actual del script
@@ -13,7 +21,130 @@ data_dir = os.path.join(current_dir, "..", "data")
 # Rutas relativas para Streamlit Cloud
 RUTA_HOSPITALES = os.path.join(data_dir, "IPRESS.csv")
 RUTA_SHAPEFILE = os.path.join(data_dir, "shape_file", "DISTRITOS.shp")
+RUTA_SHAPEFILE_PARQUET = os.path.splitext(RUTA_SHAPEFILE)[0] + ".parquet"
+# Archivos que forman el shapefile: los atributos (IDDIST, DISTRITO) están en el .dbf
+# y su codificación en el .cpg
+RUTAS_SHAPEFILE = [os.path.splitext(RUTA_SHAPEFILE)[0] + ext for ext in ('.shp', '.dbf', '.shx', '.prj', '.cpg')]
+SHAPEFILE_COLUMNS = ['IDDIST', 'DISTRITO']
 RUTA_CCPP = os.path.join(data_dir, "CCPP_0.zip")
+CCPP_COLUMNS = ['NOM_POBLAD', 'CÓDIGO', 'DIST', 'PROV', 'DEP']
+
+# Patrones para reconocer las columnas del CCPP, en orden de prioridad
+CCPP_COLUMN_PATTERNS = [
+    (re.compile(r'POBLAD|poblad'), 'NOMBCCPP'),
+    (re.compile(r'^DEP$|(?i:departamento)'), 'NOMBDEP'),
+    (re.compile(r'^PROV$|(?i:provincia)'), 'NOMBPROV'),
+    (re.compile(r'^DIST$|(?i:distrito)'), 'NOMBDIST'),
+    (re.compile(r'DIGO|(?i:codigo)'), 'IDCCPP'),
+]
+
+# Departamentos con análisis de proximidad y radio en metros
+PROXIMITY_DEPARTMENTS = ['LIMA', 'LORETO']
+PROXIMITY_RADIUS_M = 10000
+
+# Caché en disco de los resultados de load_all_data (GeoParquet).
+# Subir CACHE_VERSION cuando cambie la forma de los datos que se guardan.
+RUTA_CACHE = os.path.join(data_dir, ".cache")
+CACHE_VERSION = 18
+
+# Tolerancia de simplificación de distritos para los mapas (grados, ~500 m)
+MAP_SIMPLIFY_TOLERANCE = 0.005
+# Columnas que usan los mapas de distritos
+MAP_COLUMNS = ['UBIGEO', 'num_hospitales', 'geometry']
+# Columnas de hospitales que usa la app; la caché guarda todas pero se leen solo estas
+COLUMNS_UI = ['NOMBRE', 'UBIGEO', 'DEPARTAMENTO', 'LATITUD', 'LONGITUD', 'geometry']
+
+# Rango válido de coordenadas del Perú (grados WGS84)
+LONGITUD_PERU = (-81.5, -68.0)
+LATITUD_PERU = (-18.5, 0.0)
+
+# Tamaño de bloque al validar la codificación del CSV
+ENCODING_SAMPLE_BYTES = 64 * 1024
+
+# Transformación WGS84 -> UTM 18S (metros) para el análisis de proximidad
+TRANSFORMER_UTM = Transformer.from_crs(4326, 32718, always_xy=True)
+
+@functools.lru_cache(maxsize=8)
+def _detect_encoding(path, mtime, size):
+    """Detectar la codificación validando todo el archivo como UTF-8, por bloques
+
+    Una muestra no basta: un archivo puede empezar en UTF-8 y tener bytes
+    Latin-1 más adelante. El decodificador incremental tolera caracteres
+    multibyte cortados entre bloques.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(ENCODING_SAMPLE_BYTES), b''):
+                decoder.decode(block)
+        decoder.decode(b'', final=True)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        # Los exports de IPRESS son cp1252; latin-1 decodifica igual todas las
+        # letras acentuadas del español y, a diferencia de cp1252, nunca falla
+        return 'latin-1'
+
+def detect_encoding(path):
+    """Codificación del archivo, memoizada por ruta, fecha de modificación y tamaño"""
+    stat = os.stat(path)
+    return _detect_encoding(path, stat.st_mtime, stat.st_size)
+
+def read_hospitals_csv(columns, charenc):
+    """Leer solo las columnas pedidas del CSV y quedarse con hospitales operativos y georreferenciados
+
+    Los filtros de Estado/Condición y de coordenadas se combinan en una sola
+    máscara y se aplican en una única pasada. Estado y Condición se leen como
+    categóricas, así la comparación se hace sobre códigos enteros.
+    """
+    categorical_columns = ['Estado', 'Condición']
+    try:
+        import pyarrow as pa
+        from pyarrow import csv as pac
+        import pyarrow.compute as pc
+        dictionary_type = pa.dictionary(pa.int32(), pa.string())
+        tbl = pac.read_csv(
+            RUTA_HOSPITALES,
+            read_options=pac.ReadOptions(encoding=charenc),
+            convert_options=pac.ConvertOptions(
+                include_columns=columns,
+                column_types={col: dictionary_type for col in categorical_columns}
+            )
+        )
+        print(f"Forma original: {(tbl.num_rows, tbl.num_columns)}")
+        
+        status_mask = pc.and_kleene(pc.equal(tbl['Estado'], 'ACTIVADO'),
+                                    pc.equal(tbl['Condición'], 'EN FUNCIONAMIENTO'))
+        # Las comparaciones descartan también nulos y NaN
+        coords_mask = pc.fill_null(pc.and_kleene(
+            pc.and_kleene(pc.greater_equal(tbl['NORTE'], LONGITUD_PERU[0]),
+                          pc.less_equal(tbl['NORTE'], LONGITUD_PERU[1])),
+            pc.and_kleene(pc.greater_equal(tbl['ESTE'], LATITUD_PERU[0]),
+                          pc.less_equal(tbl['ESTE'], LATITUD_PERU[1]))
+        ), False)
+        mask = pc.and_kleene(status_mask, coords_mask)
+        n_status = pc.sum(pc.fill_null(status_mask, False)).as_py() or 0
+        n_final = pc.sum(pc.fill_null(mask, False)).as_py() or 0
+        df = tbl.filter(mask).to_pandas()
+    except Exception as arrow_error:
+        print(f"Error with pyarrow CSV reader: {arrow_error}")
+        # Alternativa con pandas y una máscara NumPy
+        df = pd.read_csv(RUTA_HOSPITALES, encoding=charenc, usecols=columns,
+                         dtype={col: 'category' for col in categorical_columns})
+        print(f"Forma original: {df.shape}")
+        status_mask = ((df['Estado'] == 'ACTIVADO').to_numpy() &
+                       (df['Condición'] == 'EN FUNCIONAMIENTO').to_numpy())
+        lon = df['NORTE'].to_numpy(dtype=float, na_value=np.nan)
+        lat = df['ESTE'].to_numpy(dtype=float, na_value=np.nan)
+        mask = (status_mask &
+                (lon >= LONGITUD_PERU[0]) & (lon <= LONGITUD_PERU[1]) &
+                (lat >= LATITUD_PERU[0]) & (lat <= LATITUD_PERU[1]))
+        n_status = int(status_mask.sum())
+        n_final = int(mask.sum())
+        df = df.iloc[np.flatnonzero(mask)]
+    
+    print(f"Después de filtro Estado=ACTIVADO y Condición=EN FUNCIONAMIENTO: {n_status} filas")
+    print(f"Después de validar coordenadas NORTE y ESTE dentro del Perú: {n_final} filas")
+    return df
 
 def load_and_clean_hospitals():
     """Cargar y limpiar datos de hospitales"""
@@ -24,24 +155,12 @@ def load_and_clean_hospitals():
             print(f"Contenido de data/: {os.listdir(data_dir) if os.path.exists(data_dir) else 'No existe'}")
             return None
         # Detectar encoding
-        with open(RUTA_HOSPITALES, 'rb') as f:
-            det = chardet.detect(f.read())
-        charenc = det['encoding']
-        
-        df = pd.read_csv(RUTA_HOSPITALES, encoding=charenc)
-        print(f"Forma original: {df.shape}")
-        
-        # Aplicar filtros
-        df_filtered = df[(df['Estado'] == 'ACTIVADO') & 
-                        (df['CondiciÛn'] == 'EN FUNCIONAMIENTO')].copy()
-        print(f"Después de filtro Estado=ACTIVADO y Condición=EN FUNCIONAMIENTO: {df_filtered.shape}")
-        
-        df_filtered = df_filtered.dropna(subset=['NORTE', 'ESTE'])
-        print(f"Después de eliminar NaN en NORTE y ESTE: {df_filtered.shape}")
+        charenc = detect_encoding(RUTA_HOSPITALES)
         
-        # Renombrar columnas
+        # Columnas a conservar y sus nuevos nombres. Pese a sus nombres, en el
+        # export de IPRESS NORTE trae la longitud (~-78) y ESTE la latitud (~-6)
         columnas_seleccionar = {
-            'CÛdigo ⁄nico': 'CODIGO_IPRESS',
+            'Código Único': 'CODIGO_IPRESS',
             'Nombre del establecimiento': 'NOMBRE', 
             'UBIGEO': 'UBIGEO',
             'NORTE': 'LONGITUD',
@@ -50,46 +169,98 @@ def load_and_clean_hospitals():
             'Estado': 'ESTADO'
         }
         
-        df_final = df_filtered[list(columnas_seleccionar.keys())].copy()
+        # Leer y aplicar filtros Estado=ACTIVADO, Condición=EN FUNCIONAMIENTO
+        # y coordenadas NORTE/ESTE dentro del Perú
+        df_filtered = read_hospitals_csv(list(columnas_seleccionar.keys()) + ['Condición'], charenc)
+        
+        # Renombrar columnas; la selección ya es un DataFrame nuevo, no hace falta copiarlo
+        df_final = df_filtered[list(columnas_seleccionar.keys())]
+        del df_filtered
         df_final.rename(columns=columnas_seleccionar, inplace=True)
         
-        return df_final
+        # UBIGEO (6 dígitos) cabe en int32; índice por UBIGEO para el join con distritos
+        df_final['UBIGEO'] = df_final['UBIGEO'].astype('int32')
+        df_final['DEPARTAMENTO'] = df_final['DEPARTAMENTO'].astype('category')
+        df_final = df_final.set_index('UBIGEO', drop=False).rename_axis(None)
+        
+        # Geometría de puntos construida una sola vez, en bloque
+        geometry = shapely.points(df_final['LONGITUD'].to_numpy(), df_final['LATITUD'].to_numpy())
+        return gpd.GeoDataFrame(df_final, geometry=geometry, crs="EPSG:4326")
         
     except Exception as e:
         print(f"Error loading hospitals data: {e}")
         return None
 
+def read_districts_shapefile():
+    """Leer solo las columnas necesarias del shapefile de distritos"""
+    # Preferir la copia GeoParquet si es más reciente que todos los archivos del shapefile
+    shapefile_mtime = max((os.path.getmtime(path) for path in RUTAS_SHAPEFILE if os.path.exists(path)),
+                          default=0.0)
+    if (os.path.exists(RUTA_SHAPEFILE_PARQUET) and
+            os.path.getmtime(RUTA_SHAPEFILE_PARQUET) >= shapefile_mtime):
+        try:
+            return gpd.read_parquet(RUTA_SHAPEFILE_PARQUET, columns=SHAPEFILE_COLUMNS + ['geometry'])
+        except Exception as parquet_error:
+            print(f"Error reading districts GeoParquet: {parquet_error}")
+    
+    try:
+        import pyogrio
+        maps = pyogrio.read_dataframe(RUTA_SHAPEFILE, columns=SHAPEFILE_COLUMNS, use_arrow=True)
+    except Exception as pyogrio_error:
+        print(f"Error with pyogrio: {pyogrio_error}")
+        # Alternativa con el lector por defecto de GeoPandas
+        maps = gpd.read_file(RUTA_SHAPEFILE)[SHAPEFILE_COLUMNS + ['geometry']]
+    
+    # Conversión única a GeoParquet para las siguientes cargas
+    try:
+        maps.to_parquet(RUTA_SHAPEFILE_PARQUET, compression='zstd')
+    except Exception as write_error:
+        print(f"Warning: could not write districts GeoParquet: {write_error}")
+    return maps
+
+def repair_invalid_geometries(gdf):
+    """Reparar con shapely.make_valid solo las geometrías inválidas"""
+    geometries = np.asarray(gdf.geometry.values)
+    invalid = ~shapely.is_valid(geometries)
+    if invalid.any():
+        print(f"Repairing {int(invalid.sum())} invalid geometries")
+        gdf = gdf.copy()
+        gdf.loc[invalid, gdf.geometry.name] = gpd.GeoSeries(
+            shapely.make_valid(geometries[invalid]), index=gdf.index[invalid], crs=gdf.crs
+        )
+    return gdf
+
 def load_and_process_shapefile():
     """Cargar y procesar shapefile de distritos"""
     try:
-        # Alternativas para leer el shapefile dependiendo de la versión de Fiona
-        try:
-            maps = gpd.read_file(RUTA_SHAPEFILE)
-        except Exception as fiona_error:
-            print(f"Error with standard read_file: {fiona_error}")
-            # Alternativa para versiones más nuevas de GeoPandas/Fiona
-            import fiona
-            try:
-                with fiona.open(RUTA_SHAPEFILE) as src:
-                    maps = gpd.GeoDataFrame.from_features(src)
-            except Exception as alt_error:
-                print(f"Error with alternative method: {alt_error}")
-                # Como último recurso, usar un método más directo
-                maps = gpd.read_file(f"/{RUTA_SHAPEFILE}")
-        
-        maps = maps[['IDDIST', 'DISTRITO', 'geometry']]
+        maps = read_districts_shapefile()
+        maps = repair_invalid_geometries(maps)
         maps = maps.rename(columns={'IDDIST': 'UBIGEO'})
-        maps['UBIGEO'] = maps['UBIGEO'].astype(str).astype(int)
+        maps['UBIGEO'] = maps['UBIGEO'].astype(str).astype('int32')
         maps = maps.to_crs(epsg=4326)
+        # Índice por UBIGEO para el join con hospitales; se mantiene el orden del shapefile
+        maps = maps.set_index('UBIGEO', drop=False).rename_axis(None)
         return maps
     except Exception as e:
         print(f"Error loading shapefile: {e}")
         return None
 
 def merge_hospitals_with_shapefile(hospitals_df, maps_gdf):
-    """Merge de hospitales con shapefile por UBIGEO"""
+    """Merge de hospitales con shapefile por UBIGEO
+
+    Ambos frames vienen indexados por UBIGEO (único en distritos), así que la
+    posición de cada hospital en el shapefile sale de un get_indexer. Las filas
+    quedan en el mismo orden que pd.merge(maps, hospitals): distritos en el
+    orden del shapefile y, dentro de cada uno, hospitales en el orden del CSV.
+    El resultado conserva la geometría de puntos de los hospitales y solo
+    toma el nombre del distrito.
+    """
     try:
-        dataset_cv = pd.merge(maps_gdf, hospitals_df, how="inner", on="UBIGEO")
+        district_pos = maps_gdf.index.get_indexer(hospitals_df.index)
+        matched = np.flatnonzero(district_pos >= 0)
+        rows = matched[np.argsort(district_pos[matched], kind='stable')]
+        dataset_cv = hospitals_df.iloc[rows].reset_index(drop=True)
+        dataset_cv['DISTRITO'] = maps_gdf['DISTRITO'].to_numpy()[district_pos[rows]]
         print(f"Merge completado: {dataset_cv.shape[0]} registros")
         return dataset_cv
     except Exception as e:
@@ -99,26 +270,59 @@ def merge_hospitals_with_shapefile(hospitals_df, maps_gdf):
 def calculate_hospital_counts(dataset_cv, maps_gdf):
     """Calcular conteo de hospitales por distrito"""
     try:
-        hospital_count = dataset_cv.groupby('UBIGEO').size().reset_index(name='num_hospitales')
-        map_data = maps_gdf.merge(hospital_count, on='UBIGEO', how='left')
-        map_data['num_hospitales'] = map_data['num_hospitales'].fillna(0)
+        hospital_count = dataset_cv['UBIGEO'].value_counts(sort=False)
+        map_data = maps_gdf.reset_index(drop=True)
+        # Conteos pequeños y no negativos: el entero sin signo más chico que alcance
+        map_data['num_hospitales'] = pd.to_numeric(map_data['UBIGEO'].map(hospital_count).fillna(0),
+                                                   downcast='unsigned')
         return map_data
     except Exception as e:
         print(f"Error calculating hospital counts: {e}")
         return None
 
+def simplify_map_data(map_data, tolerance=MAP_SIMPLIFY_TOLERANCE):
+    """Simplificar los polígonos de distritos para dibujarlos más rápido"""
+    try:
+        geometries = np.asarray(map_data.geometry.values)
+        if hasattr(shapely, 'coverage_simplify'):
+            # Simplifica los bordes compartidos una sola vez: sin huecos entre distritos
+            simplified = shapely.coverage_simplify(geometries, tolerance)
+        else:
+            simplified = shapely.simplify(geometries, tolerance, preserve_topology=True)
+        return map_data.set_geometry(gpd.GeoSeries(simplified, index=map_data.index, crs=map_data.crs))
+    except Exception as e:
+        print(f"Error simplifying district geometries: {e}")
+        return map_data
+
+def build_marker_locations(hospitals_df):
+    """Lista [lat, lon, nombre] de hospitales para los marcadores del mapa
+
+    Las coordenadas salen de la geometría (float64): LATITUD/LONGITUD son float32
+    y su repr alargaría el JSON del mapa.
+    """
+    return list(zip(hospitals_df.geometry.y.tolist(), hospitals_df.geometry.x.tolist(),
+                    hospitals_df['NOMBRE'].astype(str).tolist()))
+
 def calculate_department_stats(dataset_cv):
     """Calcular estadísticas por departamento"""
     try:
-        dept_hospitals = dataset_cv.groupby('DEPARTAMENTO').size().reset_index(name='total_hospitals')
-        dept_hospitals = dept_hospitals.sort_values('total_hospitals', ascending=False)
+        dept_hospitals = dataset_cv.groupby('DEPARTAMENTO', observed=True).size().reset_index(name='total_hospitals')
+        # Orden descendente fijado aquí: la tabla se muestra sin volver a ordenar
+        dept_hospitals = dept_hospitals.sort_values('total_hospitals', ascending=False).reset_index(drop=True)
+        dept_hospitals['total_hospitals'] = pd.to_numeric(dept_hospitals['total_hospitals'], downcast='unsigned')
+        # Texto plano: con categóricas los gráficos ordenan por categoría, no por total
+        dept_hospitals['DEPARTAMENTO'] = dept_hospitals['DEPARTAMENTO'].astype(str)
         return dept_hospitals
     except Exception as e:
         print(f"Error calculating department stats: {e}")
         return None
 
-def load_and_process_ccpp():
-    """Cargar y procesar centros poblados"""
+def load_and_process_ccpp(departments=None):
+    """Cargar y procesar centros poblados
+
+    Si se pasa departments, solo se leen los centros poblados de esos
+    departamentos (filtro aplicado por GDAL al leer).
+    """
     try:
         if not os.path.exists(RUTA_CCPP):
             print(f"Warning: CCPP file not found at {RUTA_CCPP}")
@@ -126,62 +330,111 @@ def load_and_process_ccpp():
             
         # Leer archivo ZIP correctamente para Streamlit Cloud
         try:
-            # Método 1: Formato zip estándar
-            ccpp = gpd.read_file(f"zip://{RUTA_CCPP}")
-        except Exception as zip_error:
-            print(f"Error with zip format: {zip_error}")
+            # Método 1: pyogrio con solo las columnas y departamentos necesarios
+            import pyogrio
+            where = None
+            if departments:
+                where = "DEP IN ({})".format(", ".join(f"'{dep}'" for dep in departments))
+            ccpp = pyogrio.read_dataframe(f"/vsizip/{RUTA_CCPP}", columns=CCPP_COLUMNS,
+                                          where=where, use_arrow=True)
+        except Exception as pyogrio_error:
+            print(f"Error with pyogrio: {pyogrio_error}")
+            ccpp = None
+        
+        if ccpp is None or len(ccpp) == 0:
             try:
-                # Método 2: Leer directamente
-                ccpp = gpd.read_file(RUTA_CCPP)
-            except Exception as direct_error:
-                print(f"Error with direct read: {direct_error}")
-                print("Skipping CCPP processing due to file read errors")
-                return None
+                # Método 2: Formato zip estándar
+                ccpp = gpd.read_file(f"zip://{RUTA_CCPP}")
+            except Exception as zip_error:
+                print(f"Error with zip format: {zip_error}")
+                try:
+                    # Método 3: Leer directamente
+                    ccpp = gpd.read_file(RUTA_CCPP)
+                except Exception as direct_error:
+                    print(f"Error with direct read: {direct_error}")
+                    print("Skipping CCPP processing due to file read errors")
+                    return None
         
         # Verificar columnas disponibles
         print("Columnas CCPP disponibles:", ccpp.columns.tolist())
         
-        # Mapear columnas disponibles
+        # Mapear columnas disponibles (la primera columna que coincide gana,
+        # p. ej. NOM_POBLAD antes que CAT_POBLAD, para no duplicar nombres)
         column_mapping = {}
         for col in ccpp.columns:
-            if 'POBLAD' in col or 'poblad' in col:
-                column_mapping[col] = 'NOMBCCPP'
-            elif col == 'DEP' or 'departamento' in col.lower():
-                column_mapping[col] = 'NOMBDEP'
-            elif col == 'PROV' or 'provincia' in col.lower():
-                column_mapping[col] = 'NOMBPROV'
-            elif col == 'DIST' or 'distrito' in col.lower():
-                column_mapping[col] = 'NOMBDIST'
-            elif 'DIGO' in col or 'codigo' in col.lower():
-                column_mapping[col] = 'IDCCPP'
+            target = next((name for pattern, name in CCPP_COLUMN_PATTERNS if pattern.search(col)), None)
+            if target is not None and target not in column_mapping.values():
+                column_mapping[col] = target
         
         # Verificar duplicados solo si la columna de código existe
         codigo_col = next((col for col in ccpp.columns if col in column_mapping and column_mapping[col] == 'IDCCPP'), None)
         if codigo_col:
-            ccpp = ccpp.drop_duplicates(subset=[codigo_col])
+            # Los centros poblados sin código no son duplicados entre sí
+            ccpp = ccpp[ccpp[codigo_col].isna() | ~ccpp.duplicated(subset=[codigo_col])]
         
-        ccpp = ccpp[ccpp.is_valid]
+        # Los puntos siempre son válidos; validar solo si hay otras geometrías
+        geometries = ccpp.geometry.values
+        if not (shapely.get_type_id(geometries) == shapely.GeometryType.POINT).all():
+            ccpp = ccpp.iloc[np.flatnonzero(shapely.is_valid(geometries))]
         
         # Renombrar columnas disponibles
         available_cols = [col for col in ccpp.columns if col in column_mapping]
         if available_cols:
             ccpp = ccpp.rename(columns={col: column_mapping[col] for col in available_cols})
         
+        # Departamento como categórica para filtrar por código entero
+        if 'NOMBDEP' in ccpp.columns:
+            ccpp['NOMBDEP'] = ccpp['NOMBDEP'].str.upper().astype('category')
+        
         return ccpp
         
     except Exception as e:
         print(f"Error loading CCPP: {e}")
         return None
 
-def analyze_proximity(ccpp_gdf, hospitals_gdf, department_name):
-    """Analizar proximidad para un departamento específico"""
+def find_extreme_centers(department_ccpp):
+    """Centros poblados con menos y más hospitales en 10km"""
+    if department_ccpp is None or len(department_ccpp) == 0:
+        return None, None, None
+    most_isolated = department_ccpp.loc[department_ccpp['hospitals_in_10km'].idxmin()]
+    most_concentrated = department_ccpp.loc[department_ccpp['hospitals_in_10km'].idxmax()]
+    return most_isolated, most_concentrated, department_ccpp
+
+def project_points_utm(points):
+    """Proyectar una GeoSeries de puntos WGS84 a UTM 18S con un solo llamado a pyproj"""
+    x, y = TRANSFORMER_UTM.transform(points.x.values, points.y.values)
+    return shapely.points(x, y)
+
+def project_point_utm(point):
+    """Proyectar un solo punto WGS84 a UTM 18S"""
+    x, y = TRANSFORMER_UTM.transform(point.x, point.y)
+    return shapely.Point(x, y)
+
+def build_hospital_tree(hospitals_gdf):
+    """STRtree sobre los hospitales proyectados a metros (EPSG:32718)
+
+    Los índices que devuelve el árbol son posiciones en hospitals_gdf.
+    """
+    return shapely.STRtree(project_points_utm(hospitals_gdf.geometry))
+
+def analyze_proximity(ccpp_gdf, hospitals_gdf, department_name, hosp_tree=None):
+    """Analizar proximidad para un departamento específico
+
+    hosp_tree es el STRtree métrico de build_hospital_tree; si no se pasa se
+    construye aquí, pero load_all_data lo comparte entre departamentos.
+    """
     try:
         if ccpp_gdf is None:
             print(f"CCPP data not available for {department_name}")
             return None, None, None
             
-        # Filtrar por departamento
-        department_ccpp = ccpp_gdf[ccpp_gdf['NOMBDEP'] == department_name.upper()].copy()
+        # Filtrar por departamento comparando códigos de la categórica
+        departments = ccpp_gdf['NOMBDEP'].cat.categories
+        if department_name.upper() not in departments:
+            print(f"No CCPP data found for department: {department_name}")
+            return None, None, None
+        code = departments.get_loc(department_name.upper())
+        department_ccpp = ccpp_gdf[ccpp_gdf['NOMBDEP'].cat.codes.to_numpy() == code]
         
         if len(department_ccpp) == 0:
             print(f"No CCPP data found for department: {department_name}")
@@ -189,37 +442,193 @@ def analyze_proximity(ccpp_gdf, hospitals_gdf, department_name):
             
         department_ccpp = department_ccpp.to_crs(epsg=4326)
         
-        # Crear buffers de 10km
-        def create_10km_buffer_simple(gdf):
-            gdf_metric = gdf.to_crs(epsg=32718)
-            gdf_metric['buffer_10km'] = gdf_metric.geometry.buffer(10000)
-            gdf['buffer_10km'] = gdf_metric['buffer_10km'].to_crs(epsg=4326)
-            return gdf
-        
-        department_ccpp = create_10km_buffer_simple(department_ccpp)
-        
-        # Contar hospitales en buffers
-        def count_hospitals_in_buffer(row, hospitals_gdf):
-            return len(hospitals_gdf[hospitals_gdf.geometry.within(row['buffer_10km'])])
-        
-        department_ccpp['hospitals_in_10km'] = department_ccpp.apply(
-            count_hospitals_in_buffer, args=(hospitals_gdf,), axis=1
+        # Contar hospitales a 10km con una consulta de distancia al STRtree métrico:
+        # círculo exacto, sin construir polígonos de buffer
+        if hosp_tree is None:
+            hosp_tree = build_hospital_tree(hospitals_gdf)
+        points_utm = project_points_utm(department_ccpp.geometry)
+        pairs = hosp_tree.query(points_utm, predicate='dwithin', distance=PROXIMITY_RADIUS_M)
+        department_ccpp = department_ccpp.assign(
+            hospitals_in_10km=np.bincount(pairs[0], minlength=len(department_ccpp))
         )
         
         # Encontrar centros extremos
-        if len(department_ccpp) > 0:
-            most_isolated = department_ccpp.loc[department_ccpp['hospitals_in_10km'].idxmin()]
-            most_concentrated = department_ccpp.loc[department_ccpp['hospitals_in_10km'].idxmax()]
-            return most_isolated, most_concentrated, department_ccpp
-        else:
-            return None, None, None
+        return find_extreme_centers(department_ccpp)
             
     except Exception as e:
         print(f"Error in proximity analysis for {department_name}: {e}")
         return None, None, None
 
+def _hash_geometries(h, geoseries):
+    """Agregar al hash las geometrías en WKB"""
+    h.update(b"".join(shapely.to_wkb(np.asarray(geoseries.values))))
+
+def compute_data_hash(data):
+    """Hash blake2b de los datos que entran a los mapas.
+    
+    Cubre CACHE_VERSION y MAP_SIMPLIFY_TOLERANCE; los distritos
+    simplificados (UBIGEO, conteo y geometría); los hospitales (nombre y
+    coordenadas) y los centros poblados analizados (nombre, geometría y conteo
+    a 10 km). A diferencia de la versión (fechas de los archivos), no cambia si
+    los archivos se tocan pero los datos resultantes son los mismos. El código
+    que dibuja los mapas no entra aquí: las cachés de la app lo versionan aparte.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{CACHE_VERSION}|{MAP_SIMPLIFY_TOLERANCE!r}".encode())
+    map_data = data['map_data_simplified']
+    h.update(map_data['UBIGEO'].to_numpy().tobytes())
+    h.update(map_data['num_hospitales'].to_numpy().tobytes())
+    _hash_geometries(h, map_data.geometry)
+    dataset_cv = data['dataset_cv']
+    h.update(dataset_cv[['LATITUD', 'LONGITUD']].to_numpy(dtype='float64').tobytes())
+    h.update("\n".join(dataset_cv['NOMBRE'].astype(str)).encode())
+    for name in ('lima_analysis', 'loreto_analysis'):
+        department_ccpp = data[name][2]
+        if department_ccpp is not None:
+            h.update("\n".join(department_ccpp['NOMBCCPP'].astype(str)).encode())
+            _hash_geometries(h, department_ccpp.geometry)
+            h.update(department_ccpp['hospitals_in_10km'].to_numpy().tobytes())
+    return h.hexdigest()
+
+# Módulos cuyo código define los mapas: plot.py dibuja y estimation.py aporta
+# marcadores, proyección y radio de proximidad
+CODE_FINGERPRINT_FILES = ('estimation.py', 'plot.py')
+
+@functools.lru_cache(maxsize=1)
+def code_fingerprint():
+    """Huella blake2b del código de los mapas, calculada una vez por proceso"""
+    h = hashlib.blake2b(digest_size=8)
+    for name in CODE_FINGERPRINT_FILES:
+        with open(os.path.join(current_dir, name), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def get_cache_key():
+    """Clave de caché a partir de la fecha de modificación y tamaño de los archivos de entrada"""
+    parts = [str(CACHE_VERSION)]
+    for path in (RUTA_HOSPITALES, *RUTAS_SHAPEFILE, RUTA_CCPP):
+        if os.path.exists(path):
+            parts.append(f"{os.path.basename(path)}:{os.path.getmtime(path)}:{os.path.getsize(path)}")
+        else:
+            parts.append(f"{os.path.basename(path)}:missing")
+    return hashlib.md5("|".join(parts).encode()).hexdigest()
+
+def save_data_cache(data, cache_dir):
+    """Guardar el resultado de load_all_data como archivos Parquet/GeoParquet"""
+    try:
+        tmp_dir = cache_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        
+        for name in ('maps', 'dataset_cv', 'map_data', 'map_data_simplified', 'dept_stats'):
+            data[name].to_parquet(os.path.join(tmp_dir, f"{name}.parquet"), compression='zstd')
+        for name in ('lima_analysis', 'loreto_analysis'):
+            department_ccpp = data[name][2]
+            if department_ccpp is not None:
+                department_ccpp.to_parquet(os.path.join(tmp_dir, f"{name}.parquet"), compression='zstd')
+        
+        # Reemplazar cachés anteriores por la nueva
+        if os.path.exists(RUTA_CACHE):
+            for entry in os.listdir(RUTA_CACHE):
+                if entry != os.path.basename(tmp_dir):
+                    shutil.rmtree(os.path.join(RUTA_CACHE, entry), ignore_errors=True)
+        os.replace(tmp_dir, cache_dir)
+        print(f"Cache saved to {cache_dir}")
+    except Exception as e:
+        shutil.rmtree(cache_dir + ".tmp", ignore_errors=True)
+        print(f"Warning: could not save cache: {e}")
+
+def load_data_cache(cache_dir):
+    """Cargar el resultado de load_all_data desde la caché en disco"""
+    if not os.path.isdir(cache_dir):
+        return None
+    try:
+        data = {}
+        data['dept_stats'] = pd.read_parquet(os.path.join(cache_dir, "dept_stats.parquet"))
+        for name in ('maps', 'map_data', 'map_data_simplified'):
+            data[name] = gpd.read_parquet(os.path.join(cache_dir, f"{name}.parquet"))
+        # Proyección de columnas al leer el Parquet
+        data['dataset_cv'] = gpd.read_parquet(os.path.join(cache_dir, "dataset_cv.parquet"), columns=COLUMNS_UI)
+        data['gdf_hospitales'] = data['dataset_cv']
+        data['hosp_tree'] = build_hospital_tree(data['gdf_hospitales'])
+        for name in ('lima_analysis', 'loreto_analysis'):
+            path = os.path.join(cache_dir, f"{name}.parquet")
+            department_ccpp = gpd.read_parquet(path) if os.path.exists(path) else None
+            data[name] = find_extreme_centers(department_ccpp)
+        return data
+    except Exception as e:
+        print(f"Warning: could not read cache, rebuilding: {e}")
+        return None
+
+@dataclass(slots=True, frozen=True)
+class Metrics:
+    """Métricas escalares de la app"""
+    n_hospitals: int
+    n_departamentos: int
+    n_districts: int
+    n_zero: int
+
+@dataclass(slots=True, frozen=True)
+class AppData:
+    """Resultado de load_all_data; inmutable porque se comparte entre sesiones"""
+    maps: gpd.GeoDataFrame
+    dataset_cv: gpd.GeoDataFrame
+    map_data: gpd.GeoDataFrame
+    map_data_simplified: gpd.GeoDataFrame
+    dept_stats: pd.DataFrame
+    gdf_hospitales: gpd.GeoDataFrame
+    hosp_tree: shapely.STRtree
+    lima_analysis: tuple
+    loreto_analysis: tuple
+    version: str
+    data_hash: str
+    metrics: Metrics
+    hospital_markers: list
+
+def count_unique_rows(df, column):
+    """Número de valores distintos de column: len(df) si no hay repetidos"""
+    if df[column].is_unique:
+        return len(df)
+    print(f"Aviso: {column} tiene valores repetidos; se cuentan con nunique()")
+    return int(df[column].nunique())
+
 # Función principal para cargar todos los datos
-def load_all_data():
+def load_all_data(use_cache=True):
+    """Cargar todos los datos, desde la caché en disco si los archivos no cambiaron"""
+    cache_key = get_cache_key()
+    cache_dir = os.path.join(RUTA_CACHE, cache_key)
+    data = load_data_cache(cache_dir) if use_cache else None
+    if data is not None:
+        print(f"Loaded data from cache {cache_dir}")
+    else:
+        data = build_all_data()
+        if data is None:
+            return None
+        if use_cache:
+            save_data_cache(data, cache_dir)
+        # Mismas columnas que al leer desde la caché
+        data['dataset_cv'] = data['gdf_hospitales'] = data['dataset_cv'][COLUMNS_UI]
+    
+    # float32 basta para mostrar coordenadas; la geometría sigue en float64
+    data['dataset_cv'] = data['gdf_hospitales'] = data['dataset_cv'].astype(
+        {'LATITUD': 'float32', 'LONGITUD': 'float32'})
+    
+    # Versión de los datos de entrada, para cachear lo que se construye encima
+    data['version'] = cache_key
+    # Hash del contenido, para las cachés de visualizaciones
+    data['data_hash'] = compute_data_hash(data)
+    # Métricas escalares calculadas una sola vez; una fila por distrito y por departamento
+    data['metrics'] = Metrics(
+        n_hospitals=len(data['dataset_cv']),
+        n_departamentos=count_unique_rows(data['dept_stats'], 'DEPARTAMENTO'),
+        n_districts=count_unique_rows(data['map_data'], 'UBIGEO'),
+        n_zero=int(np.count_nonzero(data['map_data']['num_hospitales'].to_numpy() == 0))
+    )
+    # Marcadores del mapa nacional, listos para FastMarkerCluster
+    data['hospital_markers'] = build_marker_locations(data['dataset_cv'])
+    return AppData(**data)
+
+def build_all_data():
     """Cargar y procesar todos los datos"""
     try:
         print("Loading hospital data...")
@@ -236,61 +645,67 @@ def load_all_data():
         
         print("Merging data...")
         dataset_cv = merge_hospitals_with_shapefile(hospitals, maps)
+        # Los hospitales sin cruzar ya no se usan: liberar antes de los análisis
+        del hospitals
         if dataset_cv is None:
             print("Failed to merge data")
             return None
         
         print("Calculating hospital counts...")
-        map_data = calculate_hospital_counts(dataset_cv, maps)
+        map_data = calculate_hospital_counts(dataset_cv[['UBIGEO']], maps)
         if map_data is None:
             print("Failed to calculate hospital counts")
             return None
         
+        print("Simplifying district geometries...")
+        map_data_simplified = simplify_map_data(map_data[MAP_COLUMNS])
+        
         print("Calculating department stats...")
-        dept_stats = calculate_department_stats(dataset_cv)
+        dept_stats = calculate_department_stats(dataset_cv[['DEPARTAMENTO']])
         if dept_stats is None:
             print("Failed to calculate department stats")
             return None
         
         print("Loading population centers...")
-        ccpp = load_and_process_ccpp()
+        ccpp = load_and_process_ccpp(PROXIMITY_DEPARTMENTS)
         # CCPP es opcional, continuar sin él si falla
         
-        # Crear GeoDataFrame de hospitales para análisis espacial
-        try:
-            gdf_hospitales = gpd.GeoDataFrame(
-                dataset_cv, 
-                geometry=gpd.points_from_xy(dataset_cv.LONGITUD, dataset_cv.LATITUD),
-                crs="EPSG:4326"
-            )
-        except Exception as e:
-            print(f"Error creating hospital GeoDataFrame: {e}")
-            return None
+        # dataset_cv ya tiene la geometría de puntos de los hospitales
+        gdf_hospitales = dataset_cv
+        
+        # Índice espacial métrico de hospitales, compartido por todos los departamentos
+        hosp_tree = build_hospital_tree(gdf_hospitales)
         
         # Análisis de proximidad (opcional)
         lima_analysis = (None, None, None)
         loreto_analysis = (None, None, None)
         
         if ccpp is not None:
-            print("Analyzing proximity for Lima...")
-            lima_analysis = analyze_proximity(ccpp, gdf_hospitales, "LIMA")
-            
-            print("Analyzing proximity for Loreto...")
-            loreto_analysis = analyze_proximity(ccpp, gdf_hospitales, "LORETO")
+            # Los análisis son independientes y GEOS libera el GIL: correrlos en paralelo
+            print("Analyzing proximity for Lima and Loreto...")
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                lima_future = executor.submit(analyze_proximity, ccpp, gdf_hospitales, "LIMA", hosp_tree)
+                loreto_future = executor.submit(analyze_proximity, ccpp, gdf_hospitales, "LORETO", hosp_tree)
+                lima_analysis = lima_future.result()
+                loreto_analysis = loreto_future.result()
         else:
             print("Skipping proximity analysis due to missing CCPP data")
         
+        del ccpp
+        gc.collect()
+        
         return {
-            'hospitals': hospitals,
             'maps': maps,
             'dataset_cv': dataset_cv,
             'map_data': map_data,
+            'map_data_simplified': map_data_simplified,
             'dept_stats': dept_stats,
             'gdf_hospitales': gdf_hospitales,
+            'hosp_tree': hosp_tree,
             'lima_analysis': lima_analysis,
             'loreto_analysis': loreto_analysis
         }
         
     except Exception as e:
-        print(f"Critical error in load_all_data: {e}")
+        print(f"Critical error in build_all_data: {e}")
         return None
\ No newline at end of file
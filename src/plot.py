@@ -1,112 +1,179 @@
-import matplotlib.pyplot as plt
-import seaborn as sns
-import folium
-from folium.plugins import MarkerCluster
-import geopandas as gpd
+import base64
+import io
+from concurrent.futures import ThreadPoolExecutor
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.style
+from matplotlib.colors import Normalize, to_hex
+from matplotlib.figure import Figure
+import numpy as np
+from estimation import (PROXIMITY_RADIUS_M, build_hospital_tree, build_marker_locations,
+                        project_point_utm)
 import streamlit as st
 
 
+# Marcador de hospital creado en JS para FastMarkerCluster: [lat, lon, nombre]
+HOSPITAL_MARKER_CALLBACK = """
+function (row) {
+    var icon = L.AwesomeMarkers.icon({icon: 'plus-sign', markerColor: '%s', prefix: 'glyphicon'});
+    var marker = L.marker(new L.LatLng(row[0], row[1]), {icon: icon});
+    var popup = document.createElement('div');
+    popup.textContent = row[2];
+    marker.bindPopup(popup);
+    return marker;
+};
+"""
+
 # Configurar estilo de gráficos
-plt.style.use('default')
-sns.set_palette("viridis")
+matplotlib.style.use('default')
+
+# Figuras con la API orientada a objetos: no quedan registradas en pyplot.
+# Los polígonos se rasterizan: miles de paths vectoriales no aportan en un PNG
+def create_map_hospitales_distrito(map_data):
+    """Mapa 1: Total de hospitales por distrito"""
+    fig = Figure(figsize=(12, 8))
+    ax = fig.add_subplot()
+    map_data.plot(column='num_hospitales', ax=ax, legend=True,
+                 cmap='YlOrRd', legend_kwds={'label': 'Número de Hospitales', 'shrink': 0.6},
+                 edgecolor='black', linewidth=0.1, rasterized=True)
+    ax.set_title('Total de Hospitales Públicos por Distrito', fontsize=14)
+    ax.set_axis_off()
+    fig.tight_layout()
+    return fig
+
+def create_map_sin_hospitales(map_data):
+    """Mapa 2: Distritos sin hospitales"""
+    fig = Figure(figsize=(12, 8))
+    ax = fig.add_subplot()
+    # Una sola pasada: colores por distrito en lugar de dibujar el subconjunto encima
+    sin_hospitales = map_data['num_hospitales'].to_numpy() == 0
+    map_data.plot(color=np.where(sin_hospitales, 'red', 'lightgray'), ax=ax,
+                  edgecolor=np.where(sin_hospitales, 'black', 'white'), linewidth=0.1, rasterized=True)
+    ax.set_title('Distritos sin Hospitales Públicos', fontsize=14)
+    ax.set_axis_off()
+    fig.tight_layout()
+    return fig
+
+def create_map_top10_distritos(map_data):
+    """Mapa 3: Top 10 distritos"""
+    fig = Figure(figsize=(12, 8))
+    ax = fig.add_subplot()
+    # Selección O(N) de los 10 mayores; solo esos 10 se ordenan
+    valores = map_data['num_hospitales'].to_numpy()
+    k = min(10, len(valores))
+    top_idx = np.argpartition(valores, len(valores) - k)[len(valores) - k:]
+    top_10_distritos = map_data.iloc[top_idx].sort_values('num_hospitales', ascending=False)
+    map_data.plot(color='lightgray', ax=ax, edgecolor='white', linewidth=0.1, rasterized=True)
+    top_10_distritos.plot(column='num_hospitales', ax=ax, legend=True,
+                         cmap='viridis', legend_kwds={'label': 'Número de Hospitales', 'shrink': 0.6},
+                         edgecolor='black', linewidth=0.5, rasterized=True)
+    ax.set_title('Top 10 Distritos con Más Hospitales', fontsize=14)
+    ax.set_axis_off()
+    fig.tight_layout()
+    return fig
 
-def create_static_maps(map_data):
-    """Crear los 3 mapas estáticos y retornar las figuras"""
+# Resolución de los PNG de mapas estáticos (st.pyplot usa 200 por defecto)
+STATIC_MAP_DPI = 100
+
+def figure_to_png(fig, dpi=STATIC_MAP_DPI):
+    """Guardar una figura como PNG en memoria y retornar los bytes"""
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', dpi=dpi, bbox_inches='tight')
+    return buffer.getvalue()
+
+def build_static_map_png(builder, map_data):
+    """Construir un mapa estático y retornarlo ya codificado como PNG"""
+    return figure_to_png(builder(map_data))
+
+STATIC_MAP_BUILDERS = {
+    'map1_hospitales_distrito': create_map_hospitales_distrito,
+    'map2_distritos_sin_hospitales': create_map_sin_hospitales,
+    'map3_top10_distritos': create_map_top10_distritos
+}
+
+def create_static_maps(map_data, as_png=False):
+    """Crear los 3 mapas estáticos y retornar las figuras (o sus PNG si as_png)"""
     if map_data is None:
         st.error("Error: map_data is None")
         return {}
-        
-    figures = {}
     
-    # Mapa 1: Total de hospitales por distrito
-    fig1, ax1 = plt.subplots(1, 1, figsize=(12, 8))
-    map_data.plot(column='num_hospitales', ax=ax1, legend=True,
-                 cmap='YlOrRd', legend_kwds={'label': 'Número de Hospitales', 'shrink': 0.6},
-                 edgecolor='black', linewidth=0.1)
-    ax1.set_title('Total de Hospitales Públicos por Distrito', fontsize=14)
-    ax1.set_axis_off()
-    plt.tight_layout()
-    figures['map1_hospitales_distrito'] = fig1
-    
-    # Mapa 2: Distritos sin hospitales
-    fig2, ax2 = plt.subplots(1, 1, figsize=(12, 8))
-    map_data.plot(color='lightgray', ax=ax2, edgecolor='white', linewidth=0.1)
-    map_data[map_data['num_hospitales'] == 0].plot(color='red', ax=ax2, edgecolor='black', linewidth=0.1)
-    ax2.set_title('Distritos sin Hospitales Públicos', fontsize=14)
-    ax2.set_axis_off()
-    plt.tight_layout()
-    figures['map2_distritos_sin_hospitales'] = fig2
-    
-    # Mapa 3: Top 10 distritos
-    fig3, ax3 = plt.subplots(1, 1, figsize=(12, 8))
-    top_10_distritos = map_data.nlargest(10, 'num_hospitales')
-    map_data.plot(color='lightgray', ax=ax3, edgecolor='white', linewidth=0.1)
-    top_10_distritos.plot(column='num_hospitales', ax=ax3, legend=True,
-                         cmap='viridis', legend_kwds={'label': 'Número de Hospitales', 'shrink': 0.6},
-                         edgecolor='black', linewidth=0.5)
-    ax3.set_title('Top 10 Distritos con Más Hospitales', fontsize=14)
-    ax3.set_axis_off()
-    plt.tight_layout()
-    figures['map3_top10_distritos'] = fig3
+    # Las figuras son independientes: construirlas en paralelo
+    figures = {}
+    with ThreadPoolExecutor(max_workers=len(STATIC_MAP_BUILDERS)) as executor:
+        if as_png:
+            # La codificación PNG también corre en el hilo de cada mapa
+            futures = {name: executor.submit(build_static_map_png, builder, map_data)
+                       for name, builder in STATIC_MAP_BUILDERS.items()}
+        else:
+            futures = {name: executor.submit(builder, map_data) for name, builder in STATIC_MAP_BUILDERS.items()}
+        for name, future in futures.items():
+            try:
+                figures[name] = future.result()
+            except Exception as e:
+                print(f"Error creating {name}: {e}")
     
     return figures
 
-def create_department_bar_chart(dept_stats):
-    """Crear gráfico de barras por departamento y retornar la figura"""
-    if dept_stats is None:
-        st.error("Error: dept_stats is None")
-        return None
-        
-    fig, ax = plt.subplots(figsize=(12, 8))
-    sns.barplot(data=dept_stats, y='DEPARTAMENTO', x='total_hospitals', ax=ax, palette='viridis')
-    ax.set_title('Número de Hospitales por Departamento', fontsize=14, fontweight='bold')
-    ax.set_xlabel('Número de Hospitales')
-    ax.set_ylabel('Departamento')
+def create_choropleth_overlay(map_data, cmap='YlOrRd', height_px=2000):
+    """Renderizar el choropleth de distritos como PNG en Web Mercator.
     
-    # Añadir valores en las barras
-    for i, v in enumerate(dept_stats['total_hospitals']):
-        ax.text(v + 0.5, i, str(int(v)), va='center', fontsize=9)
+    Retorna (url PNG en base64, bounds [[sur, oeste], [norte, este]], vmax)
+    """
+    minx, miny, maxx, maxy = map(float, map_data.total_bounds)
+    data_3857 = map_data.to_crs(epsg=3857)
+    x0, y0, x1, y1 = data_3857.total_bounds
+    vmax = max(int(map_data['num_hospitales'].max()), 1)
     
-    plt.tight_layout()
-    return fig
+    width_px = max(int(height_px * (x1 - x0) / (y1 - y0)), 1)
+    fig = Figure(figsize=(width_px / 100, height_px / 100), dpi=100)
+    ax = fig.add_axes([0, 0, 1, 1])
+    data_3857.plot(column='num_hospitales', ax=ax, cmap=cmap, norm=Normalize(0, vmax),
+                   edgecolor=(0, 0, 0, 0.2), linewidth=0.2)
+    ax.set_xlim(x0, x1)
+    ax.set_ylim(y0, y1)
+    ax.set_axis_off()
+    
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', dpi=100, transparent=True)
+    url = "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode('ascii')
+    return url, [[miny, minx], [maxy, maxx]], vmax
 
-def create_national_folium_map(map_data, dataset_cv):
+def create_national_folium_map(map_data, dataset_cv, locations=None):
     """Crear mapa Folium nacional con choropleth y markers"""
     if map_data is None or dataset_cv is None:
         st.error("Error: map_data or dataset_cv is None")
         return None
         
+    # Folium se importa al usarse: la pestaña de datos no paga su carga
+    import folium
+    from branca.colormap import LinearColormap
+    from folium.plugins import FastMarkerCluster
+    
     m = folium.Map(location=[-9.1900, -75.0152], zoom_start=5)
     
-    # Choropleth
-    folium.Choropleth(
-        geo_data=map_data.__geo_interface__,
-        data=map_data,
-        columns=['UBIGEO', 'num_hospitales'],
-        key_on='feature.properties.UBIGEO',
-        fill_color='YlOrRd',
-        fill_opacity=0.7,
-        line_opacity=0.2,
-        legend_name='Hospitales por distrito'
-    ).add_to(m)
+    # Choropleth pre-renderizado como imagen, en lugar de enviar el GeoJSON al navegador
+    image_url, bounds, vmax = create_choropleth_overlay(map_data)
+    folium.raster_layers.ImageOverlay(image=image_url, bounds=bounds, opacity=0.7,
+                                      name='Hospitales por distrito').add_to(m)
+    colors = [to_hex(c) for c in matplotlib.colormaps['YlOrRd'](np.linspace(0, 1, 9))]
+    LinearColormap(colors, vmin=0, vmax=vmax, caption='Hospitales por distrito').add_to(m)
     
-    # Marker clusters
-    marker_cluster = MarkerCluster().add_to(m)
-    for _, hospital in dataset_cv.iterrows():
-        folium.Marker(
-            location=[hospital['LATITUD'], hospital['LONGITUD']],
-            popup=hospital['NOMBRE'],
-            icon=folium.Icon(color='blue', icon='plus-sign')
-        ).add_to(marker_cluster)
+    # Marker clusters: los marcadores se crean en el navegador desde un solo arreglo
+    if locations is None:
+        locations = build_marker_locations(dataset_cv)
+    FastMarkerCluster(locations, name='hospitales', callback=HOSPITAL_MARKER_CALLBACK % 'blue').add_to(m)
     
     return m
 
-def create_proximity_map(centroid_row, hospitals_gdf, region_name, isolation_type):
+def create_proximity_map(centroid_row, hospitals_gdf, region_name, isolation_type, hosp_tree=None):
     """Crear mapa de proximidad individual"""
     if centroid_row is None:
         st.warning(f"No data available for {region_name} {isolation_type}")
         return None
         
+    import folium
+    from folium.plugins import FastMarkerCluster
+    
     m = folium.Map(
         location=[centroid_row.geometry.y, centroid_row.geometry.x], 
         zoom_start=12
@@ -122,25 +189,35 @@ def create_proximity_map(centroid_row, hospitals_gdf, region_name, isolation_typ
     # Buffer 10km
     folium.Circle(
         location=[centroid_row.geometry.y, centroid_row.geometry.x],
-        radius=10000,
+        radius=PROXIMITY_RADIUS_M,
         color='red' if isolation_type == 'isolation' else 'green',
         fill=True,
         fillOpacity=0.2,
         popup=f"{centroid_row['NOMBCCPP']} - {centroid_row['hospitals_in_10km']} hospitales"
     ).add_to(m)
     
-    # Hospitales dentro del buffer
-    buffer_hospitals = hospitals_gdf[hospitals_gdf.geometry.within(centroid_row['buffer_10km'])]
-    for _, hospital in buffer_hospitals.iterrows():
-        folium.Marker(
-            location=[hospital.geometry.y, hospital.geometry.x],
-            popup=hospital['NOMBRE'],
-            icon=folium.Icon(color='green', icon='plus-sign')
-        ).add_to(m)
+    # Hospitales a 10km, con la misma consulta de distancia que el conteo
+    if hosp_tree is None:
+        hosp_tree = build_hospital_tree(hospitals_gdf)
+    centro_utm = project_point_utm(centroid_row.geometry)
+    idx = hosp_tree.query(centro_utm, predicate='dwithin', distance=PROXIMITY_RADIUS_M)
+    buffer_hospitals = hospitals_gdf.iloc[idx]
+    
+    # Marcadores desde arreglos de coordenadas; sin agrupar al zoom inicial
+    locations = build_marker_locations(buffer_hospitals)
+    if locations:
+        FastMarkerCluster(locations, callback=HOSPITAL_MARKER_CALLBACK % 'green',
+                          options={'disableClusteringAtZoom': 12}).add_to(m)
     
     return m
 
-def create_proximity_maps(lima_analysis, loreto_analysis, gdf_hospitales):
+def folium_map_to_html(folium_map):
+    """Renderizar un mapa Folium a su documento HTML completo"""
+    if folium_map is None:
+        return None
+    return folium_map.get_root().render()
+
+def create_proximity_maps(lima_analysis, loreto_analysis, gdf_hospitales, hosp_tree=None):
     """Crear mapas de proximidad para Lima y Loreto"""
     if gdf_hospitales is None:
         st.error("Error: gdf_hospitales is None")
@@ -148,49 +225,57 @@ def create_proximity_maps(lima_analysis, loreto_analysis, gdf_hospitales):
         
     maps = {}
     
+    # Índice espacial compartido por los 4 mapas
+    if hosp_tree is None:
+        hosp_tree = build_hospital_tree(gdf_hospitales)
+    
     # Mapa Lima - Aislamiento
     if lima_analysis[0] is not None:
-        maps['lima_aislado'] = create_proximity_map(lima_analysis[0], gdf_hospitales, "Lima", "isolation")
+        maps['lima_aislado'] = create_proximity_map(lima_analysis[0], gdf_hospitales, "Lima", "isolation", hosp_tree)
     
     # Mapa Lima - Concentración
     if lima_analysis[1] is not None:
-        maps['lima_concentrado'] = create_proximity_map(lima_analysis[1], gdf_hospitales, "Lima", "concentration")
+        maps['lima_concentrado'] = create_proximity_map(lima_analysis[1], gdf_hospitales, "Lima", "concentration", hosp_tree)
     
     # Mapa Loreto - Aislamiento
     if loreto_analysis[0] is not None:
-        maps['loreto_aislado'] = create_proximity_map(loreto_analysis[0], gdf_hospitales, "Loreto", "isolation")
+        maps['loreto_aislado'] = create_proximity_map(loreto_analysis[0], gdf_hospitales, "Loreto", "isolation", hosp_tree)
     
     # Mapa Loreto - Concentración
     if loreto_analysis[1] is not None:
-        maps['loreto_concentrado'] = create_proximity_map(loreto_analysis[1], gdf_hospitales, "Loreto", "concentration")
+        maps['loreto_concentrado'] = create_proximity_map(loreto_analysis[1], gdf_hospitales, "Loreto", "concentration", hosp_tree)
     
     return maps
 
-def generate_all_visualizations(data_dict):
-    """Generar todas las visualizaciones y retornar diccionario con objetos"""
-    if data_dict is None:
-        st.error("Error: data_dict is None")
+def generate_static_visualizations(app_data, as_png=False):
+    """Generar los mapas estáticos (Matplotlib), como figuras o PNG"""
+    if app_data is None:
+        st.error("Error: app_data is None")
         return None
-        
-    st.info("Generando visualizaciones...")
     
-    # Mapas estáticos
-    static_maps = create_static_maps(data_dict['map_data'])
-    
-    # Gráfico de barras departamental
-    bar_chart = create_department_bar_chart(data_dict['dept_stats'])
+    return {'static_maps': create_static_maps(app_data.map_data_simplified, as_png)}
+
+def generate_folium_visualizations(app_data, as_html=False):
+    """Generar los mapas interactivos (Folium), como objetos o HTML ya renderizado"""
+    if app_data is None:
+        st.error("Error: app_data is None")
+        return None
     
-    # Mapas Folium
-    national_map = create_national_folium_map(data_dict['map_data'], data_dict['dataset_cv'])
+    national_map = create_national_folium_map(app_data.map_data_simplified, app_data.dataset_cv,
+                                              app_data.hospital_markers)
     proximity_maps = create_proximity_maps(
-        data_dict['lima_analysis'], 
-        data_dict['loreto_analysis'], 
-        data_dict['gdf_hospitales']
+        app_data.lima_analysis, 
+        app_data.loreto_analysis, 
+        app_data.gdf_hospitales,
+        app_data.hosp_tree
     )
     
+    if as_html:
+        # Jinja corre una sola vez; el resultado son strings serializables
+        national_map = folium_map_to_html(national_map)
+        proximity_maps = {key: folium_map_to_html(m) for key, m in proximity_maps.items()}
+    
     return {
-        'static_maps': static_maps,
-        'bar_chart': bar_chart,
         'national_map': national_map,
         'proximity_maps': proximity_maps
     }
@@ -8,12 +8,9 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# Ahora las importaciones restantes
-import pandas as pd
-import matplotlib.pyplot as plt
-import folium
-import tempfile
+# Ahora las importaciones restantes (Folium y Matplotlib se cargan solo al dibujar los mapas)
 import os
+from collections import namedtuple
 import sys
 
 # ==================== CORRECCIÓN DE IMPORTACIONES ====================
@@ -23,34 +20,21 @@ sys.path.insert(0, current_dir)
 
 # Importar módulos después de configurar el path
 try:
-    from estimation import load_all_data
-    from plot import generate_all_visualizations
+    from estimation import code_fingerprint, load_all_data
 except ImportError as e:
     st.error(f"Error importing modules: {e}")
     st.stop()
 
-def show_folium_map(folium_map, width=700, height=500):
-    """Mostrar mapa Folium de manera estable usando archivos temporales"""
-    if folium_map is None:
-        st.warning("Mapa no disponible")
-        return
-    
+def show_folium_html(html_content, width=700, height=500):
+    """Mostrar un mapa Folium a partir de su HTML ya renderizado"""
     try:
-        # Crear archivo temporal
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.html') as f:
-            folium_map.save(f.name)
-            html_file = f.name
-        
-        # Leer y mostrar el HTML
-        with open(html_file, 'r', encoding='utf-8') as f:
-            html_content = f.read()
+        if html_content is None:
+            st.warning("Mapa no disponible")
+            return
         
         # Mostrar como componente
         st.components.v1.html(html_content, width=width, height=height, scrolling=True)
         
-        # Limpiar archivo temporal
-        os.unlink(html_file)
-        
     except Exception as e:
         st.error(f"Error mostrando mapa: {e}")
 
@@ -58,8 +42,10 @@ def show_folium_map(folium_map, width=700, height=500):
 st.title("🏥 Análisis de Acceso a Hospitales en Perú")
 st.markdown("---")
 
-# Cargar datos (solo cache para datos, no para visualizaciones)
-@st.cache_data(show_spinner="Cargando datos...")
+# Cargar datos: cache_resource comparte el mismo AppData entre reruns y
+# sesiones sin copiarlo (sin pickle de las geometrías). AppData es inmutable;
+# sus DataFrames se tratan como de solo lectura.
+@st.cache_resource(ttl=3600, show_spinner="Cargando datos...")
 def load_cached_data():
     try:
         return load_all_data()
@@ -67,31 +53,77 @@ def load_cached_data():
         st.error(f"Error loading data: {e}")
         return None
 
-# Función para generar visualizaciones sin cache (porque Folium no es serializable)
-def generate_visualizations_no_cache(data_dict):
-    """Generar visualizaciones sin cache para evitar problemas de serialización"""
+# Visualizaciones cacheadas una vez por contenido de los datos (data_hash)
+# y por versión del código de los mapas (code_version).
+# Los mapas estáticos se guardan como PNG y persisten en disco: tras un
+# reinicio del servidor no se vuelven a dibujar con Matplotlib
+@st.cache_data(persist='disk', show_spinner="Generando mapas estáticos...")
+def cached_static_visualizations(data_hash, code_version, _app_data):
+    # plot (Matplotlib) se importa solo cuando hay que dibujar
+    import plot
+    visualizations = plot.generate_static_visualizations(_app_data, as_png=True)
+    # Un resultado incompleto no se guarda: la excepción evita que se persista
+    missing = set(plot.STATIC_MAP_BUILDERS) - set((visualizations or {}).get('static_maps', {}))
+    if missing:
+        raise RuntimeError(f"No se pudieron generar: {', '.join(sorted(missing))}")
+    return visualizations
+
+# Los mapas Folium se renderizan a HTML al construirlos: se cachean como strings
+@st.cache_data(ttl=3600, show_spinner=False)
+def build_folium_maps(data_hash, code_version, _app_data):
+    # _app_data no se hashea: data_hash identifica su contenido
+    import plot
+    return plot.generate_folium_visualizations(_app_data, as_html=True)
+
+HeadlineMetrics = namedtuple('HeadlineMetrics', [
+    'total_hospitals', 'total_departments', 'total_districts', 'zero_hospitals',
+    'highest_dept', 'lowest_dept', 'sample_df'
+])
+
+@st.cache_resource(ttl=3600, show_spinner=False)
+def compute_headline_metrics(version, _app_data):
+    """Métricas y resúmenes de las pestañas, calculados una vez por versión"""
+    metrics = _app_data.metrics
+    dept_stats = _app_data.dept_stats
+    return HeadlineMetrics(
+        total_hospitals=metrics.n_hospitals,
+        total_departments=metrics.n_departamentos,
+        total_districts=metrics.n_districts,
+        zero_hospitals=metrics.n_zero,
+        # O(N) y sin depender del orden de dept_stats
+        highest_dept=dept_stats.nlargest(1, 'total_hospitals').iloc[0],
+        lowest_dept=dept_stats.nsmallest(1, 'total_hospitals').iloc[0],
+        # Recortar filas antes de proyectar columnas: solo se copian 10 filas
+        sample_df=_app_data.dataset_cv.head(10)[['NOMBRE', 'DEPARTAMENTO', 'LATITUD', 'LONGITUD']]
+    )
+
+def get_viz(kind, app_data):
+    """Obtener solo las visualizaciones de una pestaña ('static' o 'folium')"""
     try:
-        return generate_all_visualizations(data_dict)
+        data_hash = app_data.data_hash
+        # Huella de estimation.py y plot.py, leída una vez por proceso
+        code_version = code_fingerprint()
+        if kind == 'static':
+            return cached_static_visualizations(data_hash, code_version, app_data)
+        return build_folium_maps(data_hash, code_version, app_data)
     except Exception as e:
         st.error(f"Error generating visualizations: {e}")
         return None
 
 # Cargar datos
-data_dict = load_cached_data()
+app_data = load_cached_data()
 
 # Verificar que los datos se cargaron correctamente
-if data_dict is None or data_dict.get('dataset_cv') is None:
+if app_data is None or app_data.dataset_cv is None:
     st.error("Error al cargar los datos. Por favor verifica las rutas de los archivos.")
     st.stop()
 
-# Crear pestañas
-tab1, tab2, tab3 = st.tabs([
-    "🗂️ Data Description", 
-    "🗺️ Static Maps & Department Analysis", 
-    "🌍 Dynamic Maps"
-])
+headline = compute_headline_metrics(app_data.version, app_data)
 
-with tab1:
+# Cada pestaña es un fragmento: al interactuar con una, solo ella se vuelve a ejecutar
+@st.fragment
+def render_tab1(headline):
+    """Pestaña 1: descripción de datos y métricas"""
     st.header("Descripción de Datos y Metodología")
     
     # Unit of analysis
@@ -108,7 +140,7 @@ with tab1:
     st.subheader("Reglas de Filtrado")
     st.write("✅ **Estado operativo**: Estado = 'ACTIVADO'")
     st.write("✅ **Condición funcional**: Condición = 'EN FUNCIONAMIENTO'")
-    st.write("✅ **Coordenadas válidas**: Latitud y longitud no nulas")
+    st.write("✅ **Coordenadas válidas**: Latitud y longitud no nulas y dentro del Perú")
     st.write("✅ **Georreferenciación**: Merge válido con shapefile por UBIGEO")
     
     # Métricas clave
@@ -118,39 +150,33 @@ with tab1:
         col1, col2, col3, col4 = st.columns(4)
         
         with col1:
-            total_hospitals = len(data_dict['dataset_cv'])
-            st.metric("Total Hospitales", total_hospitals)
+            st.metric("Total Hospitales", headline.total_hospitals)
         
         with col2:
-            total_departments = data_dict['dept_stats']['DEPARTAMENTO'].nunique()
-            st.metric("Departamentos", total_departments)
+            st.metric("Departamentos", headline.total_departments)
         
         with col3:
-            total_districts = data_dict['map_data']['UBIGEO'].nunique()
-            st.metric("Distritos", total_districts)
+            st.metric("Distritos", headline.total_districts)
         
         with col4:
-            zero_hospitals = (data_dict['map_data']['num_hospitales'] == 0).sum()
-            st.metric("Distritos sin Hospitales", zero_hospitals)
+            st.metric("Distritos sin Hospitales", headline.zero_hospitals)
     except Exception as e:
         st.error(f"Error displaying metrics: {e}")
     
     # Mostrar sample de datos
     st.subheader("Muestra de Datos de Hospitales")
     try:
-        st.dataframe(data_dict['dataset_cv'][['NOMBRE', 'DEPARTAMENTO', 'LATITUD', 'LONGITUD']].head(10))
+        st.dataframe(headline.sample_df)
     except Exception as e:
         st.error(f"Error displaying data sample: {e}")
 
-with tab2:
+@st.fragment
+def render_tab2(app_data, headline):
+    """Pestaña 2: mapas estáticos y análisis por departamento"""
     st.header("Mapas Estáticos y Análisis Departamental")
     
-    # Solo generar visualizaciones cuando se accede a esta pestaña
-    if 'tab2_visualizations' not in st.session_state:
-        with st.spinner("Generando mapas estáticos..."):
-            st.session_state.tab2_visualizations = generate_visualizations_no_cache(data_dict)
-    
-    visualizations = st.session_state.tab2_visualizations
+    # El spinner lo muestra la caché solo cuando hay que dibujar
+    visualizations = get_viz('static', app_data)
     
     # Mapas estáticos
     st.subheader("Mapas de Distribución de Hospitales")
@@ -161,20 +187,20 @@ with tab2:
             
             with col1:
                 if 'map1_hospitales_distrito' in visualizations['static_maps']:
-                    st.pyplot(visualizations['static_maps']['map1_hospitales_distrito'])
+                    st.image(visualizations['static_maps']['map1_hospitales_distrito'])
                     st.caption("Mapa 1: Hospitales por Distrito")
                 else:
                     st.warning("Mapa 1 no disponible")
             
             with col2:
                 if 'map2_distritos_sin_hospitales' in visualizations['static_maps']:
-                    st.pyplot(visualizations['static_maps']['map2_distritos_sin_hospitales'])
+                    st.image(visualizations['static_maps']['map2_distritos_sin_hospitales'])
                     st.caption("Mapa 2: Distritos sin Hospitales")
                 else:
                     st.warning("Mapa 2 no disponible")
             
             if 'map3_top10_distritos' in visualizations['static_maps']:
-                st.pyplot(visualizations['static_maps']['map3_top10_distritos'])
+                st.image(visualizations['static_maps']['map3_top10_distritos'])
                 st.caption("Mapa 3: Top 10 Distritos con Más Hospitales")
             else:
                 st.warning("Mapa 3 no disponible")
@@ -190,19 +216,18 @@ with tab2:
     try:
         # Tabla resumen
         st.write("**Tabla Resumen - Hospitales por Departamento**")
-        st.dataframe(data_dict['dept_stats'].sort_values('total_hospitals', ascending=False))
+        st.dataframe(app_data.dept_stats)
         
-        # Gráfico de barras
+        # Gráfico de barras (Vega-Lite en el navegador)
         st.write("**Gráfico de Barras - Distribución por Departamento**")
-        if visualizations and visualizations.get('bar_chart'):
-            st.pyplot(visualizations['bar_chart'])
-        else:
-            st.error("Error generando gráfico de barras")
+        st.bar_chart(app_data.dept_stats, x='DEPARTAMENTO', y='total_hospitals',
+                     x_label='Departamento', y_label='Número de Hospitales',
+                     horizontal=True, sort='-total_hospitals')
         
         # Estadísticas departamentales
         st.subheader("Estadísticas Clave")
-        highest_dept = data_dict['dept_stats'].iloc[0]
-        lowest_dept = data_dict['dept_stats'].iloc[-1]
+        highest_dept = headline.highest_dept
+        lowest_dept = headline.lowest_dept
         
         col1, col2 = st.columns(2)
         
@@ -215,21 +240,19 @@ with tab2:
     except Exception as e:
         st.error(f"Error in department analysis: {e}")
 
-with tab3:
+@st.fragment
+def render_tab3(app_data):
+    """Pestaña 3: mapas interactivos"""
     st.header("Mapas Interactivos Dinámicos")
     
-    # Solo generar visualizaciones cuando se accede a esta pestaña
-    if 'tab3_visualizations' not in st.session_state:
-        with st.spinner("Generando mapas interactivos..."):
-            st.session_state.tab3_visualizations = generate_visualizations_no_cache(data_dict)
-
-    visualizations = st.session_state.tab3_visualizations
+    with st.spinner("Generando mapas interactivos..."):
+        visualizations = get_viz('folium', app_data)
     
     # Mapa nacional
     st.subheader("Mapa Nacional - Hospitales por Distrito")
     
     if visualizations and visualizations.get('national_map'):
-        show_folium_map(visualizations['national_map'], width=700, height=500)
+        show_folium_html(visualizations['national_map'], width=700, height=500)
     else:
         st.error("Error generando mapa nacional")
     
@@ -251,14 +274,14 @@ with tab3:
             
             with col1:
                 if 'lima_aislado' in visualizations['proximity_maps'] and visualizations['proximity_maps']['lima_aislado']:
-                    show_folium_map(visualizations['proximity_maps']['lima_aislado'], width=350, height=400)
+                    show_folium_html(visualizations['proximity_maps']['lima_aislado'], width=350, height=400)
                     st.caption("Lima: Centro más aislado (menos hospitales en 10km)")
                 else:
                     st.warning("Mapa de Lima aislado no disponible")
             
             with col2:
                 if 'lima_concentrado' in visualizations['proximity_maps'] and visualizations['proximity_maps']['lima_concentrado']:
-                    show_folium_map(visualizations['proximity_maps']['lima_concentrado'], width=350, height=400)
+                    show_folium_html(visualizations['proximity_maps']['lima_concentrado'], width=350, height=400)
                     st.caption("Lima: Centro más concentrado (más hospitales en 10km)")
                 else:
                     st.warning("Mapa de Lima concentrado no disponible")
@@ -272,14 +295,14 @@ with tab3:
             
             with col1:
                 if 'loreto_aislado' in visualizations['proximity_maps'] and visualizations['proximity_maps']['loreto_aislado']:
-                    show_folium_map(visualizations['proximity_maps']['loreto_aislado'], width=350, height=400)
+                    show_folium_html(visualizations['proximity_maps']['loreto_aislado'], width=350, height=400)
                     st.caption("Loreto: Centro más aislado (menos hospitales en 10km)")
                 else:
                     st.warning("Mapa de Loreto aislado no disponible")
             
             with col2:
                 if 'loreto_concentrado' in visualizations['proximity_maps'] and visualizations['proximity_maps']['loreto_concentrado']:
-                    show_folium_map(visualizations['proximity_maps']['loreto_concentrado'], width=350, height=400)
+                    show_folium_html(visualizations['proximity_maps']['loreto_concentrado'], width=350, height=400)
                     st.caption("Loreto: Centro más concentrado (más hospitales en 10km)")
                 else:
                     st.warning("Mapa de Loreto concentrado no disponible")
@@ -298,6 +321,22 @@ with tab3:
     except Exception as e:
         st.error(f"Error in proximity maps: {e}")
 
+# Crear pestañas
+tab1, tab2, tab3 = st.tabs([
+    "🗂️ Data Description", 
+    "🗺️ Static Maps & Department Analysis", 
+    "🌍 Dynamic Maps"
+])
+
+with tab1:
+    render_tab1(headline)
+
+with tab2:
+    render_tab2(app_data, headline)
+
+with tab3:
+    render_tab3(app_data)
+
 # Footer
 st.markdown("---")
 st.caption("© 2024 - Análisis de Acceso a Hospitales en Perú | Datos: MINSA - IPRESS")
\ No newline at end of file